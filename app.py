@@ -3,21 +3,33 @@
 # =========================================
 
 # >>> BLOCK: IMPORTS -----------------------------------------------------------
+from __future__ import annotations
+
 import json
 import re
 import html
+import time
+import random
+import hashlib
+import threading
+from pathlib import Path
+from functools import lru_cache
+from bisect import insort
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 from difflib import SequenceMatcher
 
-import gspread
-import pandas as pd
+import requests
 import streamlit as st
-from gspread_dataframe import get_as_dataframe
-from gspread.utils import rowcol_to_a1
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
+
+# gspread / pandas / st_aggrid vengono importati dopo il login (vedi BLOCK: SIDEBAR – LOGIN)
+if TYPE_CHECKING:
+    import gspread
+    import pandas as pd
 # <<< END BLOCK: IMPORTS -------------------------------------------------------
 
 
@@ -37,6 +49,10 @@ SOURCE_URL = st.secrets["sheet"]["url"]
 # Cartella Drive di destinazione per le immagini (ID estratto dall'URL fornito)
 DRIVE_DEST_FOLDER_ID = "1RPXk4mFVZ9s4FPkNt_tGdycK1MdbQSMI"
 
+# Host a cui si può mandare il token OAuth per scaricare le anteprime (immagini su Drive);
+# per ogni altro URL_immagine la richiesta parte senza credenziali
+AUTH_IMAGE_HOSTS = {"drive.google.com", "docs.google.com", "www.googleapis.com"}
+
 # Colonne scrivibili (SOLO queste)
 WRITE_COLS = [
     "art_kart",
@@ -53,33 +69,72 @@ WRITE_COLS = [
 # Colonne visibili nei risultati
 RESULT_COLS = ["art_kart", "art_desart", "DescrizioneAffinata", "URL_immagine"]
 
+# Righe per pagina della tabella risultati (paginazione di AgGrid, nel browser: filtri/ordinamento
+# per colonna restano sull'intero risultato filtrato)
+GRID_PAGE_ROWS = 100
+
 # Campi con select deterministica
 SELECT_FIELDS = ["Azienda", "Prodotto", "gradazione", "annata", "Packaging", "Note"]
 
 # Campi copiati dal “simile” (inclusi i select)
 COPY_FIELDS = ["Azienda", "Prodotto", "gradazione", "annata", "Packaging", "Note", "URL_immagine"]
+
+# Snapshot su disco dell'origine (sopravvive ai riavvii di Streamlit)
+SNAPSHOT_DIR = Path(".streamlit/cache")
+SNAPSHOT_TTL = 300  # secondi, solo se la revisione del file non è disponibile
+
+# Colonne lette dall'origine (le uniche usate dall'app); None = foglio intero
+LOAD_COLS = list(dict.fromkeys(RESULT_COLS + WRITE_COLS + ["art_kmacro", "Mod?", "QxC"]))
+
+# Copie minuscole (colonne nascoste) su cui girano i filtri testuali: niente case folding per ricerca
+LOWER_COLS = {"art_kart": "_art_kart_lo", "art_desart": "_art_desart_lo", "DescrizioneAffinata": "_aff_lo"}
 # <<< END BLOCK: CONFIG E COSTANTI ---------------------------------------------
 
 
 # >>> BLOCK: HELPERS (STRINGHE, NORMALIZZAZIONE, DIFF) -------------------------
 def to_clean_str(x):
-    if x is None:
+    # caso comune per primo; niente pd.isna sugli scalari (NaN riconosciuto con x != x)
+    if type(x) is str:
+        s = x.strip()
+        return "" if len(s) == 3 and s.lower() == "nan" else s
+    if x is None or x is pd.NA or x is pd.NaT:
         return ""
-    try:
-        if pd.isna(x):
-            return ""
-    except Exception:
-        pass
-    if isinstance(x, int):
-        return str(x)
     if isinstance(x, float):
+        if x != x:
+            return ""
         if x.is_integer():
             return str(int(x))
         s = f"{x}"
         return s.rstrip("0").rstrip(".") if "." in s else s
+    if isinstance(x, int):
+        return str(x)
     s = str(x).strip()
     return "" if s.lower() == "nan" else s
 
+def clean_series(s: pd.Series) -> pd.Series:
+    """to_clean_str applicata a un'intera colonna con operazioni vettoriali (un ramo per dtype)."""
+    if pd.api.types.is_float_dtype(s):
+        is_int = s.notna() & (s % 1 == 0) & (s.abs() < 2**53)
+        out = s.astype(str)
+        out[is_int] = s[is_int].astype("int64").astype(str)
+        return out.mask(s.isna(), "")
+    if pd.api.types.is_integer_dtype(s) or pd.api.types.is_bool_dtype(s):
+        return s.astype(str)
+    if isinstance(s.dtype, pd.StringDtype):
+        out = s.fillna("").str.strip()
+        return out.mask(out.str.fullmatch("nan", case=False), "")
+    if pd.api.types.infer_dtype(s, skipna=True) in ("string", "empty"):
+        out = s.fillna("").astype(str).str.strip()
+        return out.mask(out.str.fullmatch("nan", case=False), "")
+    # colonne miste (numeri e testo): ripiego per cella
+    return s.map(to_clean_str)
+
+_int_code_re = re.compile(r"^(-?\d+)\.0+$")
+
+def clean_code(x) -> str:
+    """Codice articolo pulito: come to_clean_str, ma "123.0" → "123" anche se arriva come testo."""
+    return _int_code_re.sub(r"\1", to_clean_str(x))
+
 def normalize_spaces(s: str) -> str:
     s = to_clean_str(s)
     return " ".join(s.split())
@@ -87,35 +142,37 @@ def normalize_spaces(s: str) -> str:
 def norm_key(s: str) -> str:
     return normalize_spaces(s).casefold()
 
+def normalize_spaces_series(series: pd.Series) -> pd.Series:
+    """normalize_spaces vettoriale: split()/join come la versione scalare (anche spazi unicode, es. NBSP)."""
+    return clean_series(series).str.split().str.join(" ")
+
+def norm_key_series(series: pd.Series) -> pd.Series:
+    """norm_key vettoriale su una colonna (pulizia, spazi compattati, casefold)."""
+    return normalize_spaces_series(series).str.casefold()
+
 def unique_values_case_insensitive(series: pd.Series) -> list[str]:
-    d = {}
-    for v in series.dropna():
-        vv = normalize_spaces(v)
-        k = vv.casefold()
-        if k and k not in d:
-            d[k] = vv
-    return sorted(d.values(), key=lambda x: x.lower())
-
-def parse_sheet_url(url: str):
-    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url)
+    """Valori distinti a meno di maiuscole/spazi (vince la prima grafia), ordinati senza badare al case."""
+    s = normalize_spaces_series(series.dropna())
+    s = s[s != ""]
+    first = s[~s.str.casefold().duplicated()]
+    # ordinamento stabile sulle minuscole, vettoriale (stesso risultato di sorted(key=str.lower))
+    return first.iloc[first.str.lower().argsort(kind="stable")].tolist()
+
+# id del file + gid opzionale (in query ?gid= / &gid= o nel fragment #gid=)
+_sheet_url_re = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)(?:.*?[?#&]gid=(\d+))?")
+@lru_cache(maxsize=8)
+def parse_sheet_url(url: str) -> tuple[str, str]:
+    m = _sheet_url_re.search(url)
     if not m:
         raise ValueError("URL Google Sheet non valido.")
-    spreadsheet_id = m.group(1)
-    parsed = urlparse(url)
-    gid = None
-    if parsed.query:
-        q = parse_qs(parsed.query)
-        gid = (q.get("gid") or [None])[0]
-    if (not gid) and parsed.fragment and parsed.fragment.startswith("gid="):
-        gid = parsed.fragment.split("gid=")[1]
-    return spreadsheet_id, (gid or "0")
+    return m.group(1), (m.group(2) or "0")
 
 def str_similarity(a: str, b: str) -> float:
-    a = normalize_spaces(a).lower()
-    b = normalize_spaces(b).lower()
+    a = norm_key(a)
+    b = norm_key(b)
     if not a or not b:
         return 0.0
-    return SequenceMatcher(None, a, b).ratio()
+    return fuzz.ratio(a, b) / 100.0
 
 # --- Diff utilities (word-level, preservando spazi) ---
 _token_re = re.compile(r"\s+|[^\s]+", re.UNICODE)
@@ -143,6 +200,11 @@ def diff_old_new_html(old: str, new: str) -> tuple[str, str]:
             if seg_old: old_out.append(f"<span class='diff-del'>{seg_old}</span>")
             if seg_new: new_out.append(f"<span class='diff-ins'>{seg_new}</span>")
     return "".join(old_out), "".join(new_out)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_detail_table(pairs: tuple[tuple[str, str], ...]) -> pd.DataFrame:
+    """Tabella Campo/Valore dell'editor, ricostruita solo quando cambiano riga o valori."""
+    return pd.DataFrame(list(pairs), columns=["Campo", "Valore"])
 # <<< END BLOCK: HELPERS -------------------------------------------------------
 
 
@@ -165,16 +227,26 @@ def build_flow() -> Flow:
 def get_creds():
     if st.sidebar.button("🔁 Reset login Google"):
         st.session_state.pop("oauth_token", None)
+        st.session_state.pop("oauth_creds", None)
         st.cache_data.clear()
+        # client, worksheet e intestazione legati al vecchio token
+        get_gc_cached.clear()
+        resolve_ws.clear()
+        get_ws_header.clear()
         st.rerun()
     if "oauth_token" in st.session_state:
-        creds = Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES)
-        if creds and creds.expired and creds.refresh_token:
+        # Credentials ricostruite dal token solo la prima volta, poi riusate tra i rerun
+        creds = st.session_state.get("oauth_creds")
+        if creds is None:
+            creds = Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES)
+            st.session_state["oauth_creds"] = creds
+        if creds.expired and creds.refresh_token:
             try:
                 creds.refresh(Request())
                 st.session_state["oauth_token"] = json.loads(creds.to_json())
             except Exception:
                 st.session_state.pop("oauth_token", None)
+                st.session_state.pop("oauth_creds", None)
                 st.warning("Sessione scaduta. Rifai l’accesso.")
                 return None
         return creds
@@ -193,66 +265,293 @@ def get_creds():
             flow.fetch_token(code=code)
             creds = flow.credentials
             st.session_state["oauth_token"] = json.loads(creds.to_json())
+            st.session_state["oauth_creds"] = creds
             st.sidebar.success("Autenticazione completata ✅")
             return creds
         except Exception as e:
             if "scope has changed" in str(e).lower():
                 st.sidebar.warning("Scope cambiati: resetto il login…")
                 st.session_state.pop("oauth_token", None)
+                st.session_state.pop("oauth_creds", None)
                 st.cache_data.clear()
                 st.rerun()
             st.sidebar.error(f"Errore OAuth: {e}")
             return None
     return None
 
-def get_gc(creds_json: dict) -> gspread.Client:
-    creds = Credentials.from_authorized_user_info(creds_json, SCOPES)
+def creds_cache_key(creds: Credentials) -> str:
+    """Chiave stabile per le cache: identifica il grant (refresh_token), non il singolo access token."""
+    ident = creds.refresh_token or creds.token or ""
+    return hashlib.sha1(f"{creds.client_id}:{ident}".encode()).hexdigest()
+
+def get_gc(creds: Credentials) -> gspread.Client:
     return gspread.authorize(creds)
+
+@st.cache_resource(max_entries=16)
+def get_gc_cached(creds_key: str, expiry: str, _creds: Credentials) -> gspread.Client:
+    return get_gc(_creds)
+
+def get_client(creds: Credentials) -> gspread.Client:
+    """Client gspread riusato tra i rerun finché il token non cambia (stessa sessione HTTP)."""
+    expiry = creds.expiry.isoformat() if creds.expiry else ""
+    return get_gc_cached(creds_cache_key(creds), expiry, _creds=creds)
 # <<< END BLOCK: OAUTH ----------------------------------------------------------
 
 
+# >>> BLOCK: RETRY API GOOGLE SHEETS --------------------------------------------
+RETRY_STATUS = {429, 500, 503}
+# creazioni non idempotenti (upload/copia su Drive): un 5xx può arrivare a file già creato,
+# quindi si ritenta solo il 429, rifiutato prima di qualsiasi effetto
+RETRY_STATUS_CREATE = {429}
+RETRY_ATTEMPTS = 6
+RETRY_MAX_DELAY = 30  # secondi, tetto per backoff e Retry-After
+
+def retry_delay(resp, attempt: int) -> float:
+    """Attesa prima del tentativo successivo: Retry-After se presente, altrimenti 2^n + jitter."""
+    try:
+        delay = float(resp.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        delay = 2 ** attempt + random.random()
+    return min(delay, RETRY_MAX_DELAY)
+
+def with_retry(fn, *args, **kwargs):
+    """Chiama fn ritentando gli APIError 429/500/503 con backoff esponenziale (1, 2, 4, 8…s + jitter)."""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            resp = getattr(e, "response", None)
+            if getattr(resp, "status_code", None) not in RETRY_STATUS or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(retry_delay(resp, attempt))
+
+def with_retry_http(fn, *args, retry_status: set[int] = RETRY_STATUS, **kwargs):
+    """Come with_retry, per le chiamate REST dirette (Drive) che restituiscono una Response."""
+    for attempt in range(RETRY_ATTEMPTS):
+        resp = fn(*args, **kwargs)
+        if resp.status_code not in retry_status or attempt == RETRY_ATTEMPTS - 1:
+            return resp
+        time.sleep(retry_delay(resp, attempt))
+# <<< END BLOCK: RETRY API GOOGLE SHEETS ----------------------------------------
+
+
 # >>> BLOCK: DATA LOAD (LETTURA ORIGINE) ---------------------------------------
-@st.cache_data(ttl=300, show_spinner=True)
-def load_df(creds_json: dict, sheet_url: str) -> pd.DataFrame:
-    gc = get_gc(creds_json)
+def snapshot_path(sheet_url: str, creds_key: str) -> Path:
+    # un file per foglio e grant: il fallback a ttl (revisione "") non serve mai dati di un altro login
     spreadsheet_id, gid = parse_sheet_url(sheet_url)
-    sh = gc.open_by_key(spreadsheet_id)
-    ws = next((w for w in sh.worksheets() if str(w.id) == str(gid)), None)
-    if ws is None:
-        raise RuntimeError(f"Nessun worksheet con gid={gid}.")
+    key = hashlib.sha1(f"{creds_key}:{spreadsheet_id}:{gid}".encode()).hexdigest()[:16]
+    return SNAPSHOT_DIR / f"sheet_{key}.parquet"
 
-    tmp = get_as_dataframe(ws, evaluate_formulas=True, include_index=False, header=0)
-    if tmp is None:
-        df = pd.DataFrame()
-    elif isinstance(tmp, pd.DataFrame):
-        df = tmp
-    else:
-        df = pd.DataFrame(tmp)
+def read_snapshot(sheet_url: str, creds_key: str, revision: str) -> pd.DataFrame | None:
+    """Snapshot valido se scritto per la stessa revisione del file (modifiedTime); senza revisione vale il ttl."""
+    path = snapshot_path(sheet_url, creds_key)
+    try:
+        saved = json.loads(path.with_suffix(".json").read_text()).get("revision", "")
+        fresh = (saved == revision) if revision else (time.time() - path.stat().st_mtime < SNAPSHOT_TTL)
+        if fresh:
+            return pd.read_parquet(path)
+    except Exception:
+        pass
+    return None
+
+def write_snapshot(sheet_url: str, creds_key: str, df: pd.DataFrame, revision: str):
+    path = snapshot_path(sheet_url, creds_key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # prima si invalida il sidecar: un parquet a metà non risulta mai "fresco"
+        path.with_suffix(".json").unlink(missing_ok=True)
+        tmp = path.with_suffix(".tmp")
+        df.to_parquet(tmp)
+        tmp.replace(path)
+        path.with_suffix(".json").write_text(json.dumps({"revision": revision}))
+    except Exception:
+        pass
+
+def clear_snapshot(sheet_url: str, creds_key: str):
+    path = snapshot_path(sheet_url, creds_key)
+    path.with_suffix(".json").unlink(missing_ok=True)
+    path.unlink(missing_ok=True)
+
+def apply_load_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Dtype del df caricato; da riapplicare dopo read_parquet, che restituisce string[python]."""
+    # reparto a bassa cardinalità → category; il resto testo arrow-backed (meno RAM, filtri più rapidi)
+    for c in df.columns:
+        if c == "art_kmacro":
+            if not isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype("category")
+        elif c == "_aff_present":
+            df[c] = df[c].astype(bool)
+        else:
+            df[c] = df[c].astype("string[pyarrow]").fillna("")
+    return df
+
+def frame_from_values(rows: list[list]) -> pd.DataFrame:
+    """DataFrame da get_all_values: riga 1 = intestazioni, indice = riga del foglio - 2."""
+    if not rows:
+        return pd.DataFrame()
+    header = [to_clean_str(h) for h in rows[0]]
+    df = pd.DataFrame(rows[1:], columns=header, dtype="string[pyarrow]")
+    df = df.loc[:, [h != "" for h in header]]
+    df = df.loc[:, ~df.columns.duplicated()]
+    # scarta le righe completamente vuote (separatori) senza rinumerare l'indice
+    return df[df.ne("").any(axis=1)]
+
+def col_letter(col_idx: int) -> str:
+    return re.sub(r"\d+", "", rowcol_to_a1(1, col_idx))
+
+def read_columns(ws: gspread.Worksheet, cols: list[str] | None, header: list[str] | None = None) -> pd.DataFrame:
+    """Legge solo le colonne richieste con una values.batchGet; indice = riga del foglio - 2."""
+    if cols is None:
+        return frame_from_values(with_retry(ws.get_all_values))
+    header = [to_clean_str(h) for h in (header if header is not None else with_retry(ws.row_values, 1))]
+    wanted = [(c, header.index(c) + 1) for c in cols if c in header]
+    if not wanted:
+        return pd.DataFrame()
+    ranges = []
+    for _, idx in wanted:
+        letter = col_letter(idx)
+        ranges.append(absolute_range_name(ws.title, f"{letter}2:{letter}"))
+    resp = with_retry(ws.spreadsheet.values_batch_get, ranges, params={"majorDimension": "COLUMNS"})
+    columns = [(vr.get("values") or [[]])[0] for vr in resp.get("valueRanges", [])]
+    n_rows = max((len(v) for v in columns), default=0)
+    df = pd.DataFrame(
+        {c: v + [""] * (n_rows - len(v)) for (c, _), v in zip(wanted, columns)},
+        dtype="string[pyarrow]",
+    )
+    # scarta le righe vuote nelle colonne lette senza rinumerare l'indice
+    return df[df.ne("").any(axis=1)]
+
+def fetch_revision(gc: gspread.Client, spreadsheet_id: str) -> str:
+    """modifiedTime del file da Drive (una chiamata leggera); "" se non disponibile."""
+    try:
+        r = with_retry_http(
+            gc.session.get,
+            f"https://www.googleapis.com/drive/v3/files/{spreadsheet_id}",
+            params={"fields": "modifiedTime"},
+        )
+        if r.status_code == 200:
+            return r.json().get("modifiedTime", "")
+    except Exception:
+        pass
+    return ""
 
-    df = df.dropna(how="all")
+@st.cache_resource
+def reload_generations() -> tuple[dict[tuple[str, str], int], threading.Lock]:
+    """({(spreadsheet_id, gid): n}, lock): ricariche forzate per foglio; n entra nella chiave di load_df_cached."""
+    # condiviso tra le sessioni (ognuna nel suo thread): l'incremento passa dal lock
+    return {}, threading.Lock()
+
+def load_df(creds: Credentials, sheet_url: str, force: bool = False) -> pd.DataFrame:
+    """Df dell'origine, riletto dal foglio solo se il file è cambiato (o dopo il ttl); force = ricarica di questo foglio."""
+    spreadsheet_id, gid = parse_sheet_url(sheet_url)
+    generations, lock = reload_generations()
+    with lock:
+        if force:
+            # nuova chiave solo per questo foglio (le voci degli altri restano)
+            generations[(spreadsheet_id, gid)] = generations.get((spreadsheet_id, gid), 0) + 1
+        generation = generations.get((spreadsheet_id, gid), 0)
+    creds_key = creds_cache_key(creds)
+    if force:
+        clear_snapshot(sheet_url, creds_key)
+    revision = fetch_revision(get_client(creds), spreadsheet_id)
+    # copia per sessione: il df in cache è condiviso tra le schede, quello in session_state
+    # viene modificato in place (salvataggi ottimistici, rollback, rinomine)
+    return load_df_cached(spreadsheet_id, gid, revision, generation, creds_key, sheet_url, _creds=creds).copy()
+
+@st.cache_resource(ttl=300, show_spinner=True)
+def load_df_cached(spreadsheet_id: str, gid: str, revision: str, generation: int, creds_key: str, sheet_url: str,
+                   _creds: Credentials) -> pd.DataFrame:
+    cached = read_snapshot(sheet_url, creds_key, revision)
+    if cached is not None and set(LOWER_COLS.values()) <= set(cached.columns):
+        return apply_load_dtypes(cached)
+
+    ws = resolve_ws(creds_key, spreadsheet_id, gid, _gc=get_client(_creds))
+    # intestazione letta una volta e condivisa con ensure_headers: il primo salvataggio non la rilegge
+    fresh = [h if h is not None else "" for h in (with_retry(ws.row_values, 1) or [])]
+    set_ws_header(creds_key, spreadsheet_id, gid, ws, fresh)
+    df = read_columns(ws, LOAD_COLS, header=fresh)
 
     for col in df.columns:
-        df[col] = df[col].map(to_clean_str)
+        df[col] = clean_series(df[col])
 
-    for c in set(RESULT_COLS + WRITE_COLS):
+    # le colonne presenti sono già pulite sopra: qui si creano solo quelle mancanti,
+    # in ordine stabile e già nel dtype finale
+    for c in dict.fromkeys(RESULT_COLS + WRITE_COLS):
         if c not in df.columns:
-            df[c] = ""
-        else:
-            df[c] = df[c].map(to_clean_str)
+            df[c] = pd.Series("", index=df.index, dtype="string[pyarrow]")
+
+    # codici interi formattati con decimali ("123.0") → "123", come clean_code; niente cast
+    # a Int64, che perderebbe gli zeri iniziali e disallineerebbe le chiavi col foglio
+    # pattern come stringa (non re.Pattern): così pandas usa il kernel Arrow e non ripiega per cella
+    df["art_kart"] = df["art_kart"].str.replace(_int_code_re.pattern, r"\1", regex=True)
 
-    df["art_kart"] = df["art_kart"].map(to_clean_str)
+    df = apply_load_dtypes(df)
+
+    # flag precalcolato per il filtro Presente/Assente (valori già strip-pati)
+    df["_aff_present"] = (df["DescrizioneAffinata"].str.len() > 0).astype(bool)
+    for c, lo in LOWER_COLS.items():
+        df[lo] = df[c].str.lower()
+
+    # invariante su cui contano i confronti diretti a valle (niente .map(to_clean_str) per riga):
+    # si normalizza qui (kernel Arrow, una passata) invece di verificarlo con un assert
+    df["art_kart"] = df["art_kart"].str.strip()
+
+    write_snapshot(sheet_url, creds_key, df, revision)
     return df
+
+def is_auth_image_url(url: str) -> bool:
+    """True se l'URL è https su un host Google noto, l'unico caso in cui si manda il token."""
+    parsed = urlparse(url)
+    return parsed.scheme == "https" and (parsed.hostname or "").lower() in AUTH_IMAGE_HOSTS
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=256)
+def fetch_image_bytes(url: str, grant: str = "", _session=None) -> bytes:
+    """Byte dell'immagine, scaricati al più una volta l'ora per URL e grant (riselezione istantanea)."""
+    # l'URL viene dal foglio: la sessione autenticata solo verso host Google noti, mai verso terzi;
+    # grant (creds_cache_key) è nella chiave, così un'anteprima privata non passa a un altro login
+    get = _session.get if (grant and _session is not None and is_auth_image_url(url)) else requests.get
+    r = with_retry_http(get, url, timeout=5)
+    r.raise_for_status()
+    if not r.headers.get("Content-Type", "").startswith("image/"):
+        raise ValueError(f"Non è un'immagine: {url}")
+    return r.content
 # <<< END BLOCK: DATA LOAD ------------------------------------------------------
 
 
 
 # >>> BLOCK: DATA WRITE (UTILITY SCRITTURA) ------------------------------------
+@st.cache_resource(max_entries=16, show_spinner=False)
+def resolve_ws(creds_key: str, spreadsheet_id: str, gid: str, _gc: gspread.Client) -> gspread.Worksheet:
+    """Worksheet di destinazione risolto una volta per utente/foglio (niente worksheets() a ogni salvataggio)."""
+    sh = with_retry(_gc.open_by_key, spreadsheet_id)
+    # solo le proprietà delle schede (field mask), non tutti i metadati come get_worksheet_by_id
+    meta = with_retry(sh.fetch_sheet_metadata, params={"fields": "sheets.properties"})
+    props = next((t["properties"] for t in meta.get("sheets", []) if t["properties"].get("sheetId") == int(gid)), None)
+    if props is None:
+        raise RuntimeError(f"Nessun worksheet con gid={gid}.")
+    return gspread.Worksheet(sh, props, sh.id, sh.client)
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def get_ws_header(creds_key: str, spreadsheet_id: str, gid: str, _ws: gspread.Worksheet,
+                  _seed: tuple[str, ...] | None = None) -> tuple[str, ...]:
+    """Riga 1 del worksheet, letta una volta (o presa da _seed, già letta dal caricamento)."""
+    if _seed is not None:
+        return _seed
+    return tuple(h if h is not None else "" for h in (with_retry(_ws.row_values, 1) or []))
+
+def set_ws_header(creds_key: str, spreadsheet_id: str, gid: str, ws: gspread.Worksheet, header: list[str]):
+    """Sostituisce la voce in cache (clear + nuovo seed): la tupla condivisa tra le sessioni non si modifica mai."""
+    seed = tuple(header)
+    if get_ws_header(creds_key, spreadsheet_id, gid, _ws=ws, _seed=seed) != seed:
+        get_ws_header.clear()
+        get_ws_header(creds_key, spreadsheet_id, gid, _ws=ws, _seed=seed)
+
 def ensure_headers(ws: gspread.Worksheet, required_cols: list[str]) -> dict:
-    header = ws.row_values(1) or []
-    header = [h if h is not None else "" for h in header]
+    key = (creds_cache_key(ws.client.auth), ws.spreadsheet_id, str(ws.id))
+    header = list(get_ws_header(*key, _ws=ws))  # copia locale: le colonne nuove non toccano la voce in cache
     norm = [h.strip().lower() for h in header]
     col_map = {}
-    changed = False
+    added = {}  # {colonna: intestazione} solo per quelle nuove
     for col in required_cols:
         col_norm = col.strip().lower()
         if col_norm in norm:
@@ -262,45 +561,142 @@ def ensure_headers(ws: gspread.Worksheet, required_cols: list[str]) -> dict:
             header.append(col)
             norm.append(col_norm)
             col_map[col] = len(header)
-            changed = True
-    if changed:
-        rng = f"A1:{rowcol_to_a1(1, len(header))}"
-        ws.update(rng, [header], value_input_option="USER_ENTERED")
+            added[len(header)] = col
+    if added:
+        # si scrivono solo le celle nuove della riga 1, senza riscrivere le intestazioni esistenti
+        try:
+            with_retry(
+                ws.spreadsheet.values_batch_update,
+                {"valueInputOption": "USER_ENTERED", "data": row_ranges(ws, 1, added)},
+            )
+        except Exception:
+            get_ws_header.clear()
+            raise
+        set_ws_header(*key, ws, header)
     return col_map
 
+def key_column_index(ws: gspread.Worksheet, col_idx: int) -> dict[str, int]:
+    """{valore pulito: n. riga} dalla sola colonna chiave, dalla riga 2 (prima occorrenza vince)."""
+    letter = col_letter(col_idx)
+    resp = with_retry(
+        ws.spreadsheet.values_get,
+        absolute_range_name(ws.title, f"{letter}2:{letter}"),
+        params={"majorDimension": "COLUMNS"},
+    )
+    index = {}
+    for i, v in enumerate((resp.get("values") or [[]])[0], start=2):
+        index.setdefault(clean_code(v), i)
+    return index
+
 def find_row_number_by_art_kart_ws(ws: gspread.Worksheet, col_map: dict, art_kart: str) -> int | None:
     col_idx = col_map.get("art_kart")
     if not col_idx:
         return None
-    art_val = to_clean_str(art_kart)
-    col_vals = ws.col_values(col_idx)
-    for i, v in enumerate(col_vals[1:], start=2):
-        if to_clean_str(v) == art_val:
-            return i
-    return None
+    return key_column_index(ws, col_idx).get(clean_code(art_kart))
+
+def key_at_row(ws: gspread.Worksheet, col_idx: int, row_number: int) -> str:
+    """Valore pulito della colonna chiave in una sola riga (lettura di una cella)."""
+    resp = with_retry(ws.spreadsheet.values_get, absolute_range_name(ws.title, rowcol_to_a1(row_number, col_idx)))
+    return clean_code(((resp.get("values") or [[""]])[0] or [""])[0])
+
+def row_number_from_append(resp) -> int | None:
+    """Numero di riga scritto da append_row (da updates.updatedRange), se disponibile."""
+    try:
+        updated = resp["updates"]["updatedRange"]
+        return a1_to_rowcol(updated.split("!")[-1].split(":")[0])[0]
+    except Exception:
+        return None
 
-def upsert_in_source(ws: gspread.Worksheet, values_map: dict, art_desart_current: str) -> str:
-    col_map = ensure_headers(ws, list(dict.fromkeys(WRITE_COLS + ["art_kart"])))
-    art_val = to_clean_str(values_map.get("art_kart", ""))
+def rendered_cells(updated_data: list[dict]) -> dict[int, str]:
+    """{colonna: valore come reso dal foglio} dalle updatedData di una scrittura con includeValuesInResponse."""
+    cells = {}
+    for ud in updated_data:
+        if not ud.get("range"):
+            continue
+        bounds = ud["range"].rsplit("!", 1)[-1].split(":")
+        c0, c1 = a1_to_rowcol(bounds[0])[1], a1_to_rowcol(bounds[-1])[1]
+        vals = (ud.get("values") or [[]])[0]
+        for c in range(c0, c1 + 1):
+            cells[c] = vals[c - c0] if c - c0 < len(vals) else ""
+    return cells
+
+def row_ranges(ws: gspread.Worksheet, row_number: int, cells: dict[int, str]) -> list[dict]:
+    """Dati per values_batch_update da {colonna: valore}: colonne contigue fuse in un solo intervallo A1."""
+    cols = sorted(cells)
+    data, start = [], 0
+    for i in range(1, len(cols) + 1):
+        if i == len(cols) or cols[i] != cols[i - 1] + 1:
+            span = cols[start:i]
+            rng = rowcol_to_a1(row_number, span[0])
+            if len(span) > 1:
+                rng += ":" + rowcol_to_a1(row_number, span[-1])
+            data.append({"range": absolute_range_name(ws.title, rng), "values": [[cells[c] for c in span]]})
+            start = i
+    return data
+
+def normalize_input(values_map: dict) -> dict:
+    """Pulizia unica dei valori da scrivere, al confine UI → foglio; a valle si assumono puliti."""
+    return {k: to_clean_str(v) for k, v in values_map.items()}
+
+def upsert_in_source(ws: gspread.Worksheet, values_map: dict, art_desart_current: str,
+                     col_map: dict | None = None, row_hint: int | None = None) -> tuple[str, int | None, dict, dict]:
+    """Scrive la riga e restituisce (esito, numero riga, col_map, celle rese dal foglio); row_hint = riga attesa dal df locale."""
+    col_map = col_map or ensure_headers(ws, list(dict.fromkeys(WRITE_COLS + ["art_kart"])))
+    # values_map arriva già pulito da normalize_input: nessuna ripulitura qui
+    art_val = values_map.get("art_kart", "")
     if not art_val:
         raise RuntimeError("Campo 'art_kart' obbligatorio.")
-    values_map = {k: to_clean_str(v) for k, v in values_map.items()}
-    values_map["art_desart_precedente"] = to_clean_str(art_desart_current)
-    row_number = find_row_number_by_art_kart_ws(ws, col_map, art_val)
+    values_map = {**values_map, "art_desart_precedente": art_desart_current}
+    # riga dal df locale, verificata con una sola cella; scansione della colonna solo se non coincide
+    row_number = None
+    if row_hint is not None and key_at_row(ws, col_map["art_kart"], row_hint) == clean_code(art_val):
+        row_number = row_hint
+    if row_number is None:
+        row_number = find_row_number_by_art_kart_ws(ws, col_map, art_val)
     if row_number is not None:
-        for col in WRITE_COLS:
-            c_idx = col_map[col]
-            a1 = rowcol_to_a1(row_number, c_idx)
-            ws.update(a1, [[to_clean_str(values_map.get(col, ""))]], value_input_option="USER_ENTERED")
-        return "updated"
-    header = ws.row_values(1) or []
-    full_len = len(header)
-    new_row = ["" for _ in range(full_len)]
+        data = row_ranges(ws, row_number, {col_map[col]: values_map.get(col, "") for col in WRITE_COLS})
+        # i valori resi tornano nella risposta: niente rilettura della riga per il controllo a valle
+        resp = with_retry(
+            ws.spreadsheet.values_batch_update,
+            {"valueInputOption": "USER_ENTERED", "data": data, "includeValuesInResponse": True},
+        )
+        return "updated", row_number, col_map, rendered_cells([r.get("updatedData", {}) for r in resp.get("responses", [])])
+    # col_map copre già tutte le colonne scritte: nessuna rilettura dell'intestazione
+    new_row = ["" for _ in range(max(col_map.values()))]
     for col in WRITE_COLS:
         if col in col_map:
-            new_row[col_map[col] - 1] = to_clean_str(values_map.get(col, ""))
-    ws.append_row(new_row, value_input_option="USER_ENTERED")
-    return "added"
+            new_row[col_map[col] - 1] = values_map.get(col, "")
+    resp = with_retry(ws.append_row, new_row, value_input_option="USER_ENTERED", include_values_in_response=True)
+    return "added", row_number_from_append(resp), col_map, rendered_cells([resp.get("updates", {}).get("updatedData", {})])
+
+def write_row(ws: gspread.Worksheet, values_map: dict, art_desart_current: str, col_map: dict,
+              row_hint: int | None = None) -> tuple[str, int | None, int]:
+    """Upsert + forzatura dei SELECT_FIELDS; nessuna chiamata st.*, quindi eseguibile in un thread."""
+    result, row_number, col_map, rendered = upsert_in_source(ws, values_map, art_desart_current, col_map, row_hint)
+    if row_number is None:
+        row_number = find_row_number_by_art_kart_ws(ws, col_map, values_map["art_kart"])
+    if row_number is None:
+        return result, None, 0
+    # valori resi dalla risposta della scrittura; rilettura della riga solo se mancano
+    if not rendered:
+        rendered = dict(enumerate(with_retry(ws.row_values, row_number), start=1))
+    to_force = {}
+    for field in SELECT_FIELDS:
+        c_idx = col_map[field]
+        current_sheet_val = rendered.get(c_idx, "")
+        if normalize_spaces(current_sheet_val) != normalize_spaces(values_map[field]):
+            to_force[c_idx] = values_map[field]
+    if to_force:
+        with_retry(
+            ws.spreadsheet.values_batch_update,
+            {"valueInputOption": "USER_ENTERED", "data": row_ranges(ws, row_number, to_force)},
+        )
+    return result, row_number, len(to_force)
+
+@st.cache_resource
+def get_save_executor() -> ThreadPoolExecutor:
+    """Pool condiviso per le scritture in background (sopravvive ai rerun)."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="save")
 
 def batch_find_replace_generic(ws: gspread.Worksheet, col_name: str, old_value: str, new_value: str) -> int:
     col_map = ensure_headers(ws, [col_name])
@@ -320,7 +716,7 @@ def batch_find_replace_generic(ws: gspread.Worksheet, col_name: str, old_value:
             }
         }
     }]
-    res = ws.spreadsheet.batch_update({"requests": requests})
+    res = with_retry(ws.spreadsheet.batch_update, {"requests": requests})
     try:
         return int(res["replies"][0]["findReplace"]["occurrencesChanged"])
     except Exception:
@@ -334,35 +730,41 @@ creds = get_creds()
 if not creds:
     st.stop()
 
-def get_current_user_email(gc) -> str | None:
-    try:
-        r = gc.session.get("https://www.googleapis.com/drive/v3/about?fields=user(emailAddress)")
-        if r.status_code == 200:
-            return r.json().get("user", {}).get("emailAddress")
-    except Exception:
-        pass
-    return None
+# Import pesanti solo a login avvenuto: i giri senza token non ne pagano il costo
+import gspread
+import numpy as np
+import pandas as pd
+from gspread.utils import a1_to_rowcol, absolute_range_name, rowcol_to_a1
+from rapidfuzz import fuzz, process
+from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def get_current_user_email(creds_key: str, _gc) -> str | None:
+    """Email dell'utente OAuth, chiesta a Drive una volta per grant (la diagnostica gira a ogni rerun)."""
+    r = with_retry_http(_gc.session.get, "https://www.googleapis.com/drive/v3/about?fields=user(emailAddress)")
+    # errori sollevati, non restituiti: cache_data non memorizza le eccezioni e si riprova al rerun
+    r.raise_for_status()
+    return r.json().get("user", {}).get("emailAddress")
 
-def open_origin_ws(gc):
+def open_origin_ws(gc, creds):
     spreadsheet_id, gid = parse_sheet_url(SOURCE_URL)
-    sh = gc.open_by_key(spreadsheet_id)
-    ws = next((w for w in sh.worksheets() if str(w.id) == str(gid)), None)
-    if ws is None:
-        raise RuntimeError(f"Nessun worksheet con gid={gid}.")
-    return ws
+    return resolve_ws(creds_cache_key(creds), spreadsheet_id, gid, _gc=gc)
 
 with st.sidebar.expander("🧪 Diagnostica scrittura", expanded=False):
     try:
-        gc_dbg = get_gc(json.loads(creds.to_json()))
-        email = get_current_user_email(gc_dbg)
+        gc_dbg = get_client(creds)
+        try:
+            email = get_current_user_email(creds_cache_key(creds), _gc=gc_dbg)
+        except Exception:
+            email = None
         st.write("Utente OAuth:", email or "sconosciuto")
-        ws_dbg = open_origin_ws(gc_dbg)
+        ws_dbg = open_origin_ws(gc_dbg, creds)
         st.write("File:", ws_dbg.spreadsheet.title)
         st.write("Worksheet (gid):", ws_dbg.id)
         if st.button("Prova scrittura (Z1)"):
             from datetime import datetime
             ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ws_dbg.update("Z1", [[f"TEST {ts}"]], value_input_option="USER_ENTERED")
+            with_retry(ws_dbg.update, "Z1", [[f"TEST {ts}"]], value_input_option="USER_ENTERED")
             st.success("Scrittura di prova riuscita! (cella Z1)")
     except Exception as e:
         st.error(f"Diagnostica: {e}")
@@ -372,9 +774,12 @@ with st.sidebar.expander("🧪 Diagnostica scrittura", expanded=False):
 # >>> BLOCK: STATO APP E CACHE OPZIONI -----------------------------------------
 if "data_version" not in st.session_state:
     st.session_state["data_version"] = 0
+# modifiche locali al df (salvataggi, rinomina): invalidano le cache derivate senza cambiare le key dei widget
+st.session_state.setdefault("df_rev", 0)
+st.session_state.setdefault("session_uid", hashlib.sha1(f"{time.time_ns()}:{random.random()}".encode()).hexdigest()[:12])
 if "df" not in st.session_state:
     try:
-        st.session_state["df"] = load_df(json.loads(creds.to_json()), SOURCE_URL)
+        st.session_state["df"] = load_df(creds, SOURCE_URL)
     except Exception as e:
         st.error("❌ Errore caricando il foglio (origine).")
         st.exception(e)
@@ -403,6 +808,28 @@ for f in SELECT_FIELDS:
     if f not in st.session_state["unique_options_by_field"]:
         refresh_unique_cache(f)
 
+def options_key_index(field: str) -> dict[str, int]:
+    """{norm_key: posizione} delle opzioni del campo; ricostruito solo quando la lista viene sostituita."""
+    opts = st.session_state["unique_options_by_field"].get(field, [])
+    cached = st.session_state.setdefault("options_index_by_field", {}).get(field)
+    if cached is None or cached[0] is not opts:
+        cached = (opts, {norm_key(o): i for i, o in reversed(list(enumerate(opts)))})
+        st.session_state["options_index_by_field"][field] = cached
+    return cached[1]
+
+def update_options(field: str, remove: str | None = None, add: str | None = None):
+    """Toglie/aggiunge una voce alla lista opzioni (ordinata) senza riscansionare la colonna né riordinare tutto."""
+    index = options_key_index(field)
+    opts = list(st.session_state["unique_options_by_field"].get(field, []))
+    rm_key = norm_key(remove) if remove else None
+    if rm_key in index:
+        del opts[index[rm_key]]
+    add_key = norm_key(add) if add else None
+    if add_key and (add_key not in index or add_key == rm_key):
+        insort(opts, add, key=str.lower)
+    # lista nuova (non mutata in place): options_key_index si ricostruisce sull'identità
+    st.session_state["unique_options_by_field"][field] = opts
+
 # Mappe pending/selected/effective per campo
 def ensure_field_maps():
     if "pending_by_field" not in st.session_state:
@@ -413,6 +840,61 @@ def ensure_field_maps():
         st.session_state["effective_by_field"] = {f:{} for f in SELECT_FIELDS}
 ensure_field_maps()
 
+def df_fingerprint(df: pd.DataFrame) -> tuple:
+    """Chiave economica del df caricato: n. righe + primo/ultimo art_kart."""
+    if df.empty:
+        return (0, "", "")
+    return (len(df), str(df["art_kart"].iloc[0]), str(df["art_kart"].iloc[-1]))
+
+def df_cache_key(df: pd.DataFrame) -> tuple:
+    """Chiave delle cache derivate dal df: sessione, versione dati, modifiche locali, impronta."""
+    ss = st.session_state
+    return (ss["session_uid"], ss["data_version"], ss["df_rev"], *df_fingerprint(df))
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def key_column(df_key: tuple, col: str, _df: pd.DataFrame) -> np.ndarray:
+    """norm_key di un'intera colonna, calcolata una volta per versione del df."""
+    if col not in _df.columns:
+        return np.full(len(_df), "", dtype=object)
+    return norm_key_series(_df[col]).to_numpy(dtype=object)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def similarity_scores(df_key: tuple, target: str, _df: pd.DataFrame) -> np.ndarray:
+    """Somiglianza 0–1 di ogni art_desart con target (come str_similarity), in batch e multi-thread."""
+    keys = key_column(df_key, "art_desart", _df)
+    target = norm_key(target)
+    if not target:
+        return np.zeros(len(keys), dtype=np.float32)
+    scores = process.cdist([target], keys, scorer=fuzz.ratio, dtype=np.float32, workers=-1)[0] / 100.0
+    scores[keys == ""] = 0.0
+    return scores
+
+def touch_df():
+    """Da chiamare dopo ogni modifica in place del df locale."""
+    st.session_state["df_rev"] += 1
+
+def art_kart_positions(df: pd.DataFrame, key: str) -> np.ndarray:
+    """Posizioni delle righe con art_kart == key via indice hash, ricostruito solo se cambia il df."""
+    tag = df_cache_key(df)
+    if st.session_state.get("akart_index_tag") != tag:
+        st.session_state["akart_index"] = pd.Index(df["art_kart"].to_numpy())
+        st.session_state["akart_index_tag"] = tag
+    try:
+        loc = st.session_state["akart_index"].get_loc(key)
+    except KeyError:
+        return np.empty(0, dtype=np.intp)
+    # art_kart duplicati: get_loc restituisce slice o maschera booleana
+    if isinstance(loc, slice):
+        return np.arange(loc.start, loc.stop, loc.step or 1)
+    if isinstance(loc, (int, np.integer)):
+        return np.array([loc], dtype=np.intp)
+    return np.flatnonzero(loc)
+
+def find_row_by_art_kart(df: pd.DataFrame, key: str) -> pd.Series | None:
+    """Prima riga con art_kart == key."""
+    pos = art_kart_positions(df, key)
+    return df.iloc[pos[0]] if len(pos) else None
+
 def reset_local_state(keep_auth: bool = True):
     """Rimuove tutte le chiavi da st.session_state tranne oauth_token (se keep_auth=True)."""
     keep_keys = {"oauth_token"} if keep_auth else set()
@@ -422,11 +904,85 @@ def reset_local_state(keep_auth: bool = True):
 # <<< END BLOCK: STATO APP E CACHE OPZIONI -------------------------------------
 
 
+# >>> BLOCK: SALVATAGGI IN BACKGROUND (RICONCILIAZIONE) ------------------------
+st.session_state.setdefault("pending_saves", {})  # {art_kart: {"future", "labels", "prev", "applied", "prev_effective"}}
+
+def reconcile_pending_saves():
+    """Applica l'esito delle scritture concluse: conferma, etichetta della riga nuova o rollback locale."""
+    for art, p in list(st.session_state["pending_saves"].items()):
+        fut = p["future"]
+        if not fut.done():
+            continue
+        del st.session_state["pending_saves"][art]
+        try:
+            result, row_number, forced = fut.result()
+        except Exception as e:
+            # 400 in scrittura: probabile intestazione cambiata nel foglio, si rilegge al prossimo salvataggio
+            if isinstance(e, gspread.exceptions.APIError) and getattr(e.response, "status_code", None) == 400:
+                get_ws_header.clear()
+            if p["prev"] is None:
+                df.drop(index=p["labels"], inplace=True, errors="ignore")
+            else:
+                # si ripristinano solo le celle ancora al valore ottimistico:
+                # le modifiche locali arrivate dopo il salvataggio (es. rinomina globale) restano
+                for label in p["labels"]:
+                    if label not in df.index:
+                        continue
+                    for c in WRITE_COLS:
+                        if df.at[label, c] == p["applied"][c]:
+                            df.at[label, c] = p["prev"].at[label, c]
+            touch_df()
+            for field, v in p["prev_effective"].items():
+                if normalize_spaces(st.session_state["effective_by_field"][field].get(art, "")) != p["applied"][field]:
+                    continue
+                if v is None:
+                    st.session_state["effective_by_field"][field].pop(art, None)
+                else:
+                    st.session_state["effective_by_field"][field][art] = v
+            st.session_state["last_saved_by_art"].pop(art, None)
+            st.session_state["save_state_by_art"][art] = {"just_saved": False}
+            st.error(f"❌ Salvataggio di {art} non riuscito: modifiche locali annullate.")
+            st.exception(e)
+            continue
+        # riga nuova: riallinea l'etichetta a riga del foglio - 2 (solo se è ancora l'ultima)
+        if result == "added" and row_number is not None and p["labels"]:
+            old_label, new_label = p["labels"][0], row_number - 2
+            if old_label != new_label and old_label == df.index[-1] and new_label not in df.index:
+                df.rename(index={old_label: new_label}, inplace=True)
+                touch_df()
+        if row_number is None:
+            st.warning(f"⚠️ Non ho trovato la riga {art} nel foglio dopo il salvataggio: usa «Aggiorna dal database».")
+        if forced:
+            st.info(f"🔧 Aggiornate {forced} celle con i valori selezionati.")
+        st.toast(f"✅ Riga {art} {'aggiornata' if result == 'updated' else 'aggiunta'}.")
+
+@st.fragment(run_every=1)
+def watch_pending_saves():
+    """Finché ci sono scritture in corso, controlla ogni secondo e rilancia l'app quando finiscono."""
+    if any(p["future"].done() for p in st.session_state["pending_saves"].values()):
+        st.rerun()
+    st.caption(f"⏳ Salvataggi in corso: {', '.join(st.session_state['pending_saves'])}")
+
+reconcile_pending_saves()
+if st.session_state["pending_saves"]:
+    watch_pending_saves()
+# <<< END BLOCK: SALVATAGGI IN BACKGROUND --------------------------------------
+
+
 # >>> BLOCK: SIDEBAR – FILTRI --------------------------------------------------
+@st.cache_data(show_spinner=False, max_entries=8)
+def reparti_options(df_key: tuple, _df: pd.DataFrame) -> list[str]:
+    """Reparti distinti e ordinati; con dtype category bastano le categorie già uniche."""
+    if "art_kmacro" not in _df.columns:
+        return []
+    s = _df["art_kmacro"]
+    vals = s.cat.categories if isinstance(s.dtype, pd.CategoricalDtype) else s.dropna().unique()
+    return sorted(v for v in map(str, vals) if v.strip() != "")
+
 st.sidebar.header("🎛️ Filtri")
 f_code = st.sidebar.text_input("art_kart (codice articolo)", placeholder="es. 12345", key="f_code")
 f_desc = st.sidebar.text_input("art_desart (descrizione Bollicine)", placeholder="testo libero", key="f_desc")
-reparti = sorted([v for v in df.get("art_kmacro", pd.Series([], dtype=object)).dropna().unique() if str(v).strip() != ""])
+reparti = reparti_options(df_cache_key(df), df)
 f_reps = st.sidebar.multiselect("art_kmacro (reparto)", reparti, key="f_reps")
 pres = st.sidebar.radio("DescrizioneAffinata", ["Qualsiasi", "Presente", "Assente"], index=0, key="f_pres")
 f_aff = st.sidebar.text_input("Cerca in DescrizioneAffinata", placeholder="testo libero", key="f_aff")
@@ -435,14 +991,16 @@ f_aff = st.sidebar.text_input("Cerca in DescrizioneAffinata", placeholder="testo
 if st.sidebar.button("🔄 Aggiorna dal database"):
     try:
         oauth_backup = st.session_state.get("oauth_token")
-        st.cache_data.clear()
+        version = st.session_state.get("data_version", 0) + 1
+        # nessuna clear() globale: force rilegge solo questo foglio (nuova chiave di load_df_cached,
+        # snapshot di questo foglio rimosso) e il caricamento riallinea l'intestazione in cache;
+        # le cache derivate sono chiavate su session_uid/data_version, che qui cambiano
         reset_local_state(keep_auth=True)
         if oauth_backup is not None:
             st.session_state["oauth_token"] = oauth_backup
-        creds_json = json.loads(Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES).to_json())
-        st.session_state["df"] = load_df(creds_json, SOURCE_URL)
+        st.session_state["df"] = load_df(creds, SOURCE_URL, force=True)
         df = st.session_state["df"]
-        st.session_state["data_version"] = 0
+        st.session_state["data_version"] = version
         st.session_state["unique_options_by_field"] = {}
         for f in SELECT_FIELDS:
             refresh_unique_cache(f)
@@ -463,49 +1021,90 @@ if st.sidebar.button("🔄 Aggiorna dal database"):
 # Nuovo filtro: Solo Mod? = SI
 only_mod_si = st.sidebar.checkbox('Solo Mod? = "SI"', value=False)
 
-mask = pd.Series(True, index=df.index)
-if f_code.strip():
-    mask &= df["art_kart"].str.contains(re.escape(f_code.strip()), case=False, na=False)
-if f_desc.strip():
-    mask &= df["art_desart"].str.contains(re.escape(f_desc.strip()), case=False, na=False)
-if f_reps:
-    mask &= df["art_kmacro"].isin(f_reps)
-if pres == "Presente":
-    mask &= df["DescrizioneAffinata"].str.strip() != ""
-elif pres == "Assente":
-    mask &= df["DescrizioneAffinata"].str.strip() == ""
-if f_aff.strip():
-    mask &= df["DescrizioneAffinata"].str.contains(re.escape(f_aff.strip()), case=False, na=False)
-if only_mod_si and "Mod?" in df.columns:
-    mask &= df["Mod?"].map(lambda x: to_clean_str(x).upper() == "SI")
-
-filtered = df.loc[mask].copy()
+@st.cache_data(show_spinner=False, max_entries=64)
+def contains_mask(df_key: tuple, col: str, needle: str, _df: pd.DataFrame) -> np.ndarray:
+    """Maschera di una sola ricerca testuale; cambiando un filtro le maschere degli altri si riusano."""
+    return _df[col].str.contains(needle, na=False, regex=False).to_numpy(dtype=bool, na_value=False)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def filter_index(df_key: tuple, f_code: str, f_desc: str, f_reps: tuple, pres: str, f_aff: str,
+                 only_mod_si: bool, _df: pd.DataFrame) -> pd.Index:
+    """Indici delle righe che passano i filtri; a input invariati non riscansiona il df."""
+    df = _df
+    # solo i filtri attivi producono una maschera (array numpy), combinate in un'unica AND
+    masks = []
+    if f_code:
+        masks.append(contains_mask(df_key, "_art_kart_lo", f_code.lower(), df))
+    if f_desc:
+        masks.append(contains_mask(df_key, "_art_desart_lo", f_desc.lower(), df))
+    if f_reps:
+        masks.append(df["art_kmacro"].isin(f_reps))
+    if pres == "Presente":
+        masks.append(df["_aff_present"])
+    elif pres == "Assente":
+        masks.append(~df["_aff_present"])
+    if f_aff:
+        masks.append(contains_mask(df_key, "_aff_lo", f_aff.lower(), df))
+    if only_mod_si and "Mod?" in df.columns:
+        masks.append(df["Mod?"].str.upper() == "SI")
+    if not masks:
+        return df.index
+    masks = [m if isinstance(m, np.ndarray) else m.to_numpy(dtype=bool, na_value=False) for m in masks]
+    return df.index[np.logical_and.reduce(masks)]
+
+# chiave: stato del df + filtri; i reparti ordinati così l'ordine di selezione non conta
+df_key = df_cache_key(df)
+filter_args = (f_code.strip(), f_desc.strip(), tuple(sorted(f_reps)), pres, f_aff.strip(), only_mod_si)
+keep_idx = filter_index(df_key, *filter_args, df)
 # <<< END BLOCK: SIDEBAR – FILTRI ----------------------------------------------
 
 
 # >>> BLOCK: LAYOUT PRINCIPALE (SX RISULTATI / DX DETTAGLIO) -------------------
+# cache_resource: il risultato filtrato (anche tutto il catalogo) non viene ripicklato a ogni rerun; è di sola lettura
+@st.cache_resource(show_spinner=False, max_entries=16)
+def grid_frame(df_key: tuple, filter_args: tuple, _df: pd.DataFrame, _keep_idx: pd.Index) -> pd.DataFrame:
+    """Righe filtrate pronte per AgGrid: solo le colonne visibili, icona al posto dell'URL."""
+    out = _df.loc[_keep_idx, [c for c in RESULT_COLS if c in _df.columns]]
+    if "URL_immagine" in out.columns:
+        urls = out["URL_immagine"]
+        out = out.assign(URL_immagine=urls.where(urls == "", "🖼️"))
+    return out
+
+@st.cache_data(show_spinner=False)
+def grid_options_for(columns: tuple[str, ...]) -> dict:
+    """gridOptions dipendono solo dalle colonne: costruite una volta."""
+    gb = GridOptionsBuilder.from_dataframe(pd.DataFrame(columns=list(columns)))
+    # filtri/ordinamento per colonna lato browser: affinare i risultati non causa rerun
+    gb.configure_default_column(filter="agTextColumnFilter", floatingFilter=True, sortable=True)
+    gb.configure_selection("single", use_checkbox=True)
+    gb.configure_grid_options(domLayout="normal")
+    # paginazione nel browser: si rende una pagina alla volta, ma i filtri di colonna vedono tutte le righe
+    gb.configure_pagination(enabled=True, paginationAutoPageSize=False, paginationPageSize=GRID_PAGE_ROWS)
+    if "art_kart" in columns:
+        gb.configure_column("art_kart", header_name="art_kart", pinned="left")
+    if "URL_immagine" in columns:
+        gb.configure_column("URL_immagine", header_name="Immagine", filter=False, floatingFilter=False)
+    return gb.build()
+
+def show_image(url: str, caption: str):
+    """Anteprima da byte in cache; se il download fallisce ci prova il browser con l'URL."""
+    try:
+        if is_auth_image_url(url):
+            data = fetch_image_bytes(url, creds_cache_key(creds), _session=get_client(creds).session)
+        else:
+            data = fetch_image_bytes(url)
+    except Exception:
+        data = url
+    st.image(data, use_container_width=True, caption=caption)
+
 left, right = st.columns([1, 1.6], gap="large")
 
 with left:
-    present_cols = [c for c in RESULT_COLS if c in filtered.columns]
-    filtered_results = filtered[present_cols].copy()
-    if "art_kart" in filtered_results.columns:
-        filtered_results["art_kart"] = filtered_results["art_kart"].map(to_clean_str)
-
-    # Mostra icone al posto dell'URL
-    if "URL_immagine" in filtered_results.columns:
-        filtered_results["URL_immagine"] = filtered_results["URL_immagine"].map(
-            lambda u: "🖼️" if to_clean_str(u) != "" else ""
-        )
+    grid_options = grid_options_for(tuple(c for c in RESULT_COLS if c in df.columns))
 
-    gb = GridOptionsBuilder.from_dataframe(filtered_results)
-    gb.configure_selection("single", use_checkbox=True)
-    gb.configure_grid_options(domLayout="normal")
-    if "art_kart" in filtered_results.columns:
-        gb.configure_column("art_kart", header_name="art_kart", pinned="left")
-    if "URL_immagine" in filtered_results.columns:
-        gb.configure_column("URL_immagine", header_name="Immagine")
-    grid_options = gb.build()
+    # tutte le righe filtrate (così filtri/ordinamento di colonna coprono l'intero risultato),
+    # ma solo le colonne visibili: è tutto ciò che AgGrid serializza
+    filtered_results = grid_frame(df_key, filter_args, df, keep_idx)
 
     grid_resp = AgGrid(
         filtered_results,
@@ -539,10 +1138,7 @@ with left:
         # Trova la riga completa nel df
         full_row_left = None
         if "art_kart" in selected_row and "art_kart" in df.columns:
-            key = to_clean_str(selected_row["art_kart"])
-            matches = df[df["art_kart"].map(to_clean_str) == key]
-            if not matches.empty:
-                full_row_left = matches.iloc[0]
+            full_row_left = find_row_by_art_kart(df, to_clean_str(selected_row["art_kart"]))
         if full_row_left is None:
             full_row_left = pd.Series({c: selected_row.get(c, "") for c in df.columns})
 
@@ -553,17 +1149,17 @@ with left:
         # Preview se esiste URL_immagine
         if current_img_url_left:
             try:
-                st.image(current_img_url_left, use_container_width=True, caption="Anteprima (URL_immagine)")
+                show_image(current_img_url_left, "Anteprima (URL_immagine)")
             except Exception:
                 st.caption("Anteprima non disponibile (URL non raggiungibile).")
             st.code(current_img_url_left, language="text")
         else:
             # Dropdown candidati con stesso art_desart (esclusa riga corrente) che hanno URL
             same_desc = df[
-                (df["art_desart"].map(norm_key) == norm_key(current_art_desart_left))
-                & (df["art_kart"].map(to_clean_str) != current_art_kart_left)
-                & (df["URL_immagine"].map(lambda x: to_clean_str(x) != ""))
-            ][["art_kart", "art_desart", "URL_immagine"]].copy()
+                (key_column(df_cache_key(df), "art_desart", df) == norm_key(current_art_desart_left))
+                & (df["art_kart"] != current_art_kart_left)
+                & (df["URL_immagine"] != "")
+            ][["art_kart", "art_desart", "URL_immagine"]]
 
             st.caption("Nessuna immagine su questa riga. Puoi:")
             c_pick, c_up = st.columns([0.60, 0.40])
@@ -595,7 +1191,7 @@ with left:
                             "url": chosen["url"],
                         }
                         try:
-                            st.image(chosen["url"], use_container_width=True, caption=f"Anteprima selezionata da #{chosen['kart']}")
+                            show_image(chosen["url"], f"Anteprima selezionata da #{chosen['kart']}")
                         except Exception:
                             st.caption("Anteprima non disponibile (URL non raggiungibile).")
                         st.code(chosen["url"], language="text")
@@ -652,10 +1248,7 @@ with right:
         # riga completa dall'origine locale
         full_row = None
         if "art_kart" in selected_row and "art_kart" in df.columns:
-            key = to_clean_str(selected_row["art_kart"])
-            matches = df[df["art_kart"].map(to_clean_str) == key]
-            if not matches.empty:
-                full_row = matches.iloc[0]
+            full_row = find_row_by_art_kart(df, to_clean_str(selected_row["art_kart"]))
         if full_row is None:
             full_row = pd.Series({c: selected_row.get(c, "") for c in df.columns})
 
@@ -741,13 +1334,15 @@ with right:
 
 # >>> BLOCK: DETTAGLIO – SUGGERIMENTI SIMILI -----------------------------------
         try:
-            base = df[df["art_kart"].map(to_clean_str) != current_art_kart].copy()
-            base["__sim_current__"] = base["art_desart"].apply(lambda s: str_similarity(s, current_art_desart))
-            cand = base.sort_values("__sim_current__", ascending=False).head(300).copy()
+            # punteggi su una Series a parte (in cache per riga selezionata): nessuna copia del df
+            scores = pd.Series(similarity_scores(df_cache_key(df), current_art_desart, df), index=df.index)
+            scores = scores[(df["art_kart"] != current_art_kart).to_numpy()]
+            top = scores.nlargest(300)
+            cand = df.loc[top.index]
 
             labels = [
                 f"{to_clean_str(r.get('art_desart',''))} — {to_clean_str(r.get('art_kart',''))} ({sim:.2f})"
-                for r, sim in zip(cand.to_dict('records'), cand["__sim_current__"])
+                for r, sim in zip(cand.to_dict('records'), top)
             ]
             idx_options = [-1] + list(range(len(cand)))
             label_map = {-1: "— scegli —", **{i: labels[i] for i in range(len(labels))}}
@@ -792,8 +1387,8 @@ with right:
             new_val = st.text_input("Nuovo nome", value="", placeholder=f"Nuovo valore per «{col_name}»…")
 
             # Calcolo righe coinvolte + elenco DescrizioneAffinata
-            mask_aff = (df.get(col_name, pd.Series([], dtype=object)).map(norm_key) == norm_key(old_val))
-            affected = df.loc[mask_aff, ["art_kart", "DescrizioneAffinata"]].copy() if "DescrizioneAffinata" in df.columns else df.loc[mask_aff, ["art_kart"]].copy()
+            mask_aff = key_column(df_cache_key(df), col_name, df) == norm_key(old_val)
+            affected = df.loc[mask_aff, ["art_kart", "DescrizioneAffinata"]] if "DescrizioneAffinata" in df.columns else df.loc[mask_aff, ["art_kart"]]
             X = int(mask_aff.sum())
             st.warning(f"⚠️ Modificherai **{X}** righe nel foglio. Confermi?")
             with st.expander("Vedi elenco descrizioni interessate", expanded=False):
@@ -809,24 +1404,21 @@ with right:
             with c1:
                 if st.button("✅ Conferma rinomina", disabled=(normalize_spaces(new_val) == "")):
                     try:
-                        creds_json = json.loads(Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES).to_json())
-                        gc = get_gc(creds_json)
-                        ws = open_origin_ws(gc)
+                        gc = get_client(creds)
+                        ws = open_origin_ws(gc, creds)
                         old_clean = normalize_spaces(old_val)
                         new_clean = normalize_spaces(new_val)
-                        for v in st.session_state["unique_options_by_field"].get(col_name, []):
-                            if norm_key(v) == norm_key(new_clean):
-                                new_clean = v; break
+                        opts = st.session_state["unique_options_by_field"].get(col_name, [])
+                        i_opt = options_key_index(col_name).get(norm_key(new_clean))
+                        if i_opt is not None:
+                            new_clean = opts[i_opt]
                         changed = batch_find_replace_generic(ws, col_name, old_clean, new_clean)
 
                         # stato locale
-                        mask_local = df[col_name].map(norm_key) == norm_key(old_clean)
-                        df.loc[mask_local, col_name] = new_clean
+                        df.loc[mask_aff, col_name] = new_clean
                         st.session_state["df"] = df
-                        opts = st.session_state["unique_options_by_field"].get(col_name, [])
-                        opts = [new_clean if norm_key(o) == norm_key(old_clean) else o for o in opts]
-                        if all(norm_key(new_clean) != norm_key(o) for o in opts): opts.append(new_clean)
-                        st.session_state["unique_options_by_field"][col_name] = sorted({norm_key(o): o for o in opts}.values(), key=lambda x: x.lower())
+                        touch_df()
+                        update_options(col_name, remove=old_clean, add=new_clean)
 
                         st.session_state["pending_by_field"][col_name][current_art_kart]  = new_clean
                         st.session_state["selected_by_field"][col_name][current_art_kart] = new_clean
@@ -850,11 +1442,7 @@ with right:
             with c1:
                 if st.button("➕ Crea e usa", disabled=(normalize_spaces(candidate) == "")):
                     cand = normalize_spaces(candidate)
-                    if all(norm_key(cand) != norm_key(v) for v in st.session_state["unique_options_by_field"].get(col_name, [])):
-                        st.session_state["unique_options_by_field"][col_name] = sorted(
-                            st.session_state["unique_options_by_field"].get(col_name, []) + [cand],
-                            key=lambda x: x.lower()
-                        )
+                    update_options(col_name, add=cand)
                     st.session_state["pending_by_field"][col_name][current_art_kart] = cand
                     st.session_state["selected_by_field"][col_name][current_art_kart] = cand
                     st.session_state["effective_by_field"][col_name][current_art_kart] = cand
@@ -881,9 +1469,16 @@ with right:
                 or current_val
             )
             options = [""] + unique_opts
-            if default_value and all(norm_key(default_value) != norm_key(v) for v in options):
-                options.append(default_value)
-            def_idx = next((i for i, opt in enumerate(options) if norm_key(opt) == norm_key(default_value or "")), 0)
+            # posizione in options = posizione in unique_opts + 1 (la voce vuota è in testa)
+            def_key = norm_key(default_value or "")
+            def_idx = 0
+            if def_key:
+                pos = options_key_index(col_name).get(def_key)
+                if pos is None:
+                    options.append(default_value)
+                    def_idx = len(options) - 1
+                else:
+                    def_idx = pos + 1
             col_label, col_select, col_edit, col_add = st.columns([0.22, 0.58, 0.10, 0.10])
             with col_label:
                 st.markdown(f"<div class='labelcell'>{col_name}</div>", unsafe_allow_html=True)
@@ -911,14 +1506,13 @@ with right:
 
 # >>> BLOCK: DETTAGLIO – EDITOR “ALTRI CAMPI” ----------------------------------
         other_cols = [c for c in WRITE_COLS if c not in SELECT_FIELDS]
-        pairs = [{"Campo": c, "Valore": to_clean_str(full_row.get(c, ""))} for c in other_cols]
         prefill_map = (st.session_state.get("prefill_by_art_kart", {}) or {}).get(current_art_kart, {})
-        if prefill_map:
-            for p in pairs:
-                if p["Campo"] in prefill_map and prefill_map[p["Campo"]] != "":
-                    p["Valore"] = prefill_map[p["Campo"]]
-        detail_key = f"detail_{to_clean_str(full_row.get('art_kart',''))}_{st.session_state['data_version']}"
-        detail_table = pd.DataFrame(pairs, columns=["Campo", "Valore"])
+        pairs = tuple(
+            (c, prefill_map[c] if prefill_map.get(c, "") != "" else to_clean_str(full_row.get(c, "")))
+            for c in other_cols
+        )
+        detail_key = f"detail_{current_art_kart}_{st.session_state['data_version']}"
+        detail_table = build_detail_table(pairs)
         edited_detail = st.data_editor(
             detail_table,
             use_container_width=True,
@@ -933,14 +1527,15 @@ with right:
 
 # >>> BLOCK: DETTAGLIO – STATO SALVATO/NON SALVATO -----------------------------
         current_select_values = {f: get_current_value(f) for f in SELECT_FIELDS}
-        current_other_values = {}
+        # Campo/Valore dell'editor in un solo passaggio (niente iterrows per riga)
         try:
-            for _, r in edited_detail.iterrows():
-                campo = to_clean_str(r.get("Campo", ""))
-                if campo in other_cols:
-                    current_other_values[campo] = normalize_spaces(to_clean_str(r.get("Valore", "")))
+            edited_pairs = {
+                to_clean_str(k): to_clean_str(v)
+                for k, v in zip(edited_detail["Campo"].tolist(), edited_detail["Valore"].tolist())
+            }
         except Exception:
-            current_other_values = {c: normalize_spaces(to_clean_str(full_row.get(c, ""))) for c in other_cols}
+            edited_pairs = {c: to_clean_str(full_row.get(c, "")) for c in other_cols}
+        current_other_values = {c: normalize_spaces(v) for c, v in edited_pairs.items() if c in other_cols}
 
         snapshot = st.session_state["last_saved_by_art"].get(current_art_kart, {})
         dirty_fields = []
@@ -986,11 +1581,7 @@ with right:
 
         if save_clicked:
             try:
-                values_map = {}
-                for _, r in edited_detail.iterrows():
-                    campo = to_clean_str(r.get("Campo", ""))
-                    if campo and campo in other_cols:
-                        values_map[campo] = to_clean_str(r.get("Valore", ""))
+                values_map = {c: v for c, v in edited_pairs.items() if c in other_cols}
 
                 for field in SELECT_FIELDS:
                     values_map[field] = normalize_spaces(current_select_values.get(field, ""))
@@ -1026,8 +1617,7 @@ with right:
 
                 if uploaded and uploaded.get("file"):
                     up_file = uploaded["file"]
-                    creds_json = json.loads(Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES).to_json())
-                    gc = get_gc(creds_json)
+                    gc = get_client(creds)
                     session = _drive_api(gc)
                     files = {
                         "metadata": (
@@ -1037,9 +1627,11 @@ with right:
                         ),
                         "file": (new_filename, up_file.getvalue(), up_file.type or "application/octet-stream"),
                     }
-                    resp = session.post(
+                    resp = with_retry_http(
+                        session.post,
                         "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart",
                         files=files,
+                        retry_status=RETRY_STATUS_CREATE,
                     )
                     resp.raise_for_status()
                     new_file_id = resp.json().get("id")
@@ -1052,12 +1644,13 @@ with right:
                     m = re.search(r"[?&]id=([A-Za-z0-9_-]+)", src_url)
                     if m:
                         src_id = m.group(1)
-                        creds_json = json.loads(Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES).to_json())
-                        gc = get_gc(creds_json)
+                        gc = get_client(creds)
                         session = _drive_api(gc)
-                        resp = session.post(
+                        resp = with_retry_http(
+                            session.post,
                             f"https://www.googleapis.com/drive/v3/files/{src_id}/copy",
                             json={"name": new_filename, "parents": [DRIVE_DEST_FOLDER_ID]},
+                            retry_status=RETRY_STATUS_CREATE,
                         )
                         resp.raise_for_status()
                         new_file_id = resp.json().get("id")
@@ -1066,42 +1659,47 @@ with right:
                         st.session_state["picked_image_by_art"].pop(current_art_kart, None)
                 # --- fine gestione immagine ---
 
-                creds_json = json.loads(Credentials.from_authorized_user_info(st.session_state["oauth_token"], SCOPES).to_json())
-                gc = get_gc(creds_json)
-                spreadsheet_id, gid = parse_sheet_url(SOURCE_URL)
-                ws = next((w for w in gc.open_by_key(spreadsheet_id).worksheets() if str(w.id) == str(gid)), None)
-                if ws is None:
-                    raise RuntimeError(f"Nessun worksheet con gid={gid} nell'origine.")
-
-                art_desart_current = to_clean_str(full_row.get("art_desart", ""))
-                result = upsert_in_source(ws, values_map, art_desart_current)
+                if current_art_kart in st.session_state["pending_saves"]:
+                    st.warning("⏳ Un salvataggio di questa riga è ancora in corso, riprova tra un attimo.")
+                    st.stop()
 
+                # worksheet e intestazione (in cache) risolti qui: il thread fa solo le scritture
+                ws = open_origin_ws(get_client(creds), creds)
                 col_map = ensure_headers(ws, list(dict.fromkeys(WRITE_COLS + ["art_kart"])))
-                row_number = find_row_number_by_art_kart_ws(ws, col_map, art_val)
-                if row_number is not None:
-                    to_force = []
-                    for field in SELECT_FIELDS:
-                        a1 = rowcol_to_a1(row_number, col_map[field])
-                        current_sheet_val = ws.acell(a1).value or ""
-                        if normalize_spaces(current_sheet_val) != normalize_spaces(values_map[field]):
-                            to_force.append((a1, values_map[field]))
-                    for a1, v in to_force:
-                        ws.update(a1, [[v]], value_input_option="USER_ENTERED")
-                    if to_force:
-                        st.info(f"🔧 Aggiornate {len(to_force)} celle con i valori selezionati.")
-                else:
-                    st.warning("⚠️ Non ho trovato la riga nel foglio dopo il salvataggio. Provo a ricaricare i dati…")
+                values_map = normalize_input(values_map)
+                art_desart_current = to_clean_str(full_row.get("art_desart", ""))
+                # riga attesa nel foglio dall'indice locale (etichetta = riga - 2), prima di toccare il df
+                hit = find_row_by_art_kart(df, art_val)
+                row_hint = int(hit.name) + 2 if hit is not None else None
 
-                # aggiorna effective + df locale
+                # aggiornamento ottimistico di effective + df locale, con lo stato precedente per il rollback
+                prev_effective = {f: st.session_state["effective_by_field"][f].get(current_art_kart) for f in SELECT_FIELDS}
                 for field in SELECT_FIELDS:
                     st.session_state["effective_by_field"][field][current_art_kart] = values_map[field]
-                mask_row = df["art_kart"].map(to_clean_str) == art_val
-                if mask_row.any():
-                    for field in SELECT_FIELDS:
-                        df.loc[mask_row, field] = normalize_spaces(values_map[field])
-                    for c in [c for c in WRITE_COLS if c not in SELECT_FIELDS]:
-                        df.loc[mask_row, c] = normalize_spaces(values_map.get(c, ""))
+                local_vals = {c: normalize_spaces(values_map.get(c, "")) for c in WRITE_COLS}
+                local_vals["art_desart_precedente"] = art_desart_current
+                labels = list(df.index[art_kart_positions(df, art_val)])
+                if labels:
+                    # mutazione in place cella per cella (.at): nessuna maschera per colonna né copia del df
+                    prev = df.loc[labels, WRITE_COLS].copy()
+                    for label in labels:
+                        for c, v in local_vals.items():
+                            df.at[label, c] = v
+                else:
+                    # riga nuova: append in place con .loc (niente concat né copia del df);
+                    # l'etichetta provvisoria viene riallineata a riga del foglio - 2 a scrittura conclusa
+                    new_label = (df.index.max() + 1) if len(df) else 0
+                    labels, prev = [new_label], None
+                    new_row = {c: "" for c in df.columns}
+                    new_row.update(local_vals)
+                    new_row["_aff_present"] = False
+                    new_row.update({lo: new_row[c].lower() for c, lo in LOWER_COLS.items()})
+                    df.loc[new_label] = pd.Series(new_row)
+                    # l'allargamento con .loc porta a object tutte le colonne di testo (anche le _*_lo dei filtri)
+                    # e il reparto: si ripristinano i dtype del caricamento (string[pyarrow], category, bool)
+                    apply_load_dtypes(df)
                     st.session_state["df"] = df
+                touch_df()
 
                 # snapshot per il badge
                 snapshot_new = {}
@@ -1112,11 +1710,12 @@ with right:
                 st.session_state["last_saved_by_art"][current_art_kart] = snapshot_new
                 st.session_state["save_state_by_art"][current_art_kart] = {"just_saved": True}
 
-                if result == "updated":
-                    st.success(f"✅ Riga {art_val} aggiornata.")
-                elif result == "added":
-                    st.success(f"✅ Nuova riga {art_val} aggiunta.")
-                st.toast("Salvato!", icon="✅")
+                fut = get_save_executor().submit(write_row, ws, values_map, art_desart_current, col_map, row_hint)
+                st.session_state["pending_saves"][current_art_kart] = {
+                    "future": fut, "labels": labels, "prev": prev, "applied": local_vals, "prev_effective": prev_effective,
+                }
+                st.toast("Salvataggio avviato…", icon="⏳")
+                st.rerun()
 
             except Exception as e:
                 st.error("❌ Errore durante il salvataggio:")